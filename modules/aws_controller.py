@@ -1,11 +1,17 @@
 import os
 import ansible_runner
+import codecs
+import gzip
+import io
+import selectors
 import subprocess
 import sys
 import signal
+import time
 import yaml
 import json
 
+from concurrent.futures import ThreadPoolExecutor
 from python_terraform import Terraform, IsNotFlagged
 from modules import aws_service, splunk_sdk
 from tabulate import tabulate
@@ -17,19 +23,51 @@ from modules.art_simulation_controller import ArtSimulationController
 from modules.purplesharp_simulation_controller import PurplesharpSimulationController
 
 
+MODULE_PATH = Path(__file__).resolve().parent
+ROOT_PATH = MODULE_PATH.parent
+TERRAFORM_PATH = ROOT_PATH / 'terraform' / 'aws'
+ANSIBLE_ROLES_PATH = MODULE_PATH / 'ansible' / 'roles'
+DATA_REPLAY_PLAYBOOK = MODULE_PATH / 'ansible' / 'data_replay.yml'
+
+INSTANCES_CACHE_TTL = 30
+
+SIMULATION_CONTROLLERS = {
+    "ART": ArtSimulationController,
+    "PurpleSharp": PurplesharpSimulationController
+}
+
+# access information printed by show(), selected by the prefix of the instance name
+MESSAGE_TEMPLATES = {
+    "ar-splunk": "\nAccess Guacamole via:\n\tWeb > http://{ip}:8080/guacamole\n\tusername: Admin \n\tpassword: {password}\n"
+                 "\nAccess Splunk via:\n\tWeb > {splunk_scheme}://{ip}:8000\n\tSSH > ssh -i{key} ubuntu@{ip}\n\tusername: admin \n\tpassword: {password}",
+    "ar-phantom": "\nAccess Phantom via:\n\tWeb > https://{ip}:8443\n\tSSH > ssh -i{key} centos@{ip}\n\tusername: admin \n\tpassword: {password}",
+    "ar-win": "\nAccess Windows via:\n\tRDP > rdp://{ip}:3389\n\tusername: Administrator \n\tpassword: {password}",
+    "ar-linux": "\nAccess Linux via:\n\tSSH > ssh -i{key} ubuntu@{ip}\n\tusername: ubuntu \n\tpassword: {password}",
+    "ar-kali": "\nAccess Kali via:\n\tSSH > ssh -i{key} kali@{ip}\n\tusername: kali \n\tpassword: {password}",
+    "ar-nginx": "\nAccess Nginx Web Proxy via:\n\tSSH > ssh -i{key} ubuntu@{ip}\n\tusername: kali \n\tpassword: {password}",
+    "ar-zeek": "\nAccess Zeek via:\n\tSSH > ssh -i{key} ubuntu@{ip}\n\tusername: ubuntu \n\tpassword: {password}"
+}
+
+
 class AwsController(AttackRangeController):
 
     def __init__(self, config: dict):
         super().__init__(config)
         statefile = self.config['general']['attack_range_name'] + ".terraform.tfstate"
-        self.config['general']["statepath"] = os.path.join(os.path.dirname(__file__), '../terraform/aws/state', statefile)
+        self.config['general']["statepath"] = str(TERRAFORM_PATH / 'state' / statefile)
+        self.instances = None
+        self.instances_timestamp = 0
+        self.simulation_controllers = {}
 
         if not aws_service.check_region(self.config['aws']['region']):
             self.logger.error("AWS cli region and region in config file are not the same.")
             sys.exit(1)
 
-        working_dir = os.path.join(os.path.dirname(__file__), '../terraform/aws')
-        self.terraform = Terraform(working_dir=working_dir,variables=config, parallelism=15, state= self.config['general']["statepath"])
+        working_dir = str(TERRAFORM_PATH)
+        parallelism = int(self.config['aws'].get('terraform_parallelism', "0"))
+        if parallelism <= 0:
+            parallelism = max(15, (os.cpu_count() or 1) * 3)
+        self.terraform = Terraform(working_dir=working_dir,variables=config, parallelism=parallelism, state= self.config['general']["statepath"])
 
         if self.config['general']['use_prebuilt_images_with_packer'] == "0":
             for i in range(len(self.config['windows_servers'])):
@@ -50,10 +88,8 @@ class AwsController(AttackRangeController):
             images = []
             if self.config['splunk_server']['byo_splunk'] == "0":
                 images.append(self.config['splunk_server']['splunk_image'])
-            for windows_server in self.config['windows_servers']:
-                images.append(windows_server['windows_image'])
-            for linux_server in self.config['linux_servers']:
-                images.append(linux_server['linux_image'])
+            images += [windows_server['windows_image'] for windows_server in self.config['windows_servers']]
+            images += [linux_server['linux_image'] for linux_server in self.config['linux_servers']]
             if self.config["nginx_server"]["nginx_server"] == "1":
                 images.append(self.config["nginx_server"]["nginx_image"])
             if self.config["zeek_server"]["zeek_server"] == "1":
@@ -61,49 +97,124 @@ class AwsController(AttackRangeController):
             if self.config["phantom_server"]["phantom_server"] == "1":
                 images.append(self.config["phantom_server"]["phantom_image"])    
 
+            # servers often share an image, check every image only once
+            images = list(dict.fromkeys(images))
+
             self.logger.info("Check if images are available in region " + self.config['aws']['region'])
+            status = aws_service.ami_available_batch(images, self.config['aws']['region'])
 
+            missing_images = []
             for image in images:
-                if not aws_service.ami_available(image, self.config['aws']['region']):
+                if status[image]:
+                    self.logger.info("Image " + image + " is available in region " + self.config['aws']['region'])
+                else:
                     self.logger.info("Image " + image + " is not available in region " + self.config['aws']['region'])
                     self.logger.info("Checking if image " + image + " is available in other regions.")
-                    result = aws_service.ami_available_other_region(image)
-                    if result:
-                        self.logger.info("Found image " + image + " in region " + result['region'] + ". Copy it to region " + self.config['aws']['region'])
-                        aws_service.copy_image(
-                            image, 
-                            result['image_id'], 
-                            result['region'],
-                            self.config['aws']['region']
-                        )
-                    else:
+                    missing_images.append(image)
+
+            if missing_images:
+                results = aws_service.ami_available_other_region_batch(missing_images)
+
+                images_to_build = []
+                for image in missing_images:
+                    if not self.copy_image_from_other_region(image, results[image]):
                         self.logger.info("Image " + image + " need to be built with packer.")
-                        self.packer(image)  
-                else:
-                    self.logger.info("Image " + image + " is available in region " + self.config['aws']['region'])                 
+                        images_to_build.append(image)
+
+                # packer builds are independent of each other, the output is prefixed with the image name
+                if images_to_build:
+                    self.build_images(images_to_build)
      
 
         cwd = os.getcwd()
-        os.system('cd ' + os.path.join(os.path.dirname(__file__), '../terraform/aws') + '&& terraform init ')
+        os.system('cd ' + str(TERRAFORM_PATH) + '&& terraform init ')
         os.system('cd ' + cwd)
 
-        return_code, stdout, stderr = self.terraform.apply(
-            capture_output='yes', 
-            skip_plan=True, 
-            no_color=IsNotFlagged
-        )
-
-        if not return_code:
-            self.logger.info("attack_range has been built using terraform successfully")
+        # plan with -detailed-exitcode returns 0 for no changes, 1 for errors and 2 for changes
+        # the plan is saved, so apply executes exactly what was planned against the refreshed state
+        plan_file = TERRAFORM_PATH / (self.config['general']['attack_range_name'] + ".tfplan")
+        try:
+            return_code, stdout, stderr = self.terraform.plan(
+                capture_output='yes', 
+                no_color=IsNotFlagged,
+                refresh=self.config['aws'].get('terraform_refresh', "1") == "1",
+                out=str(plan_file)
+            )
+
+            if return_code == 0:
+                self.logger.info("No infrastructure changes, skipping terraform apply")
+            elif return_code == 2:
+                # Terraform.apply() adds -var options, which are not allowed with a saved plan
+                return_code, stdout, stderr = self.terraform.cmd(
+                    'apply',
+                    str(plan_file),
+                    capture_output='yes', 
+                    input=False,
+                    no_color=IsNotFlagged,
+                    parallelism=self.terraform.parallelism,
+                    state=self.config['general']["statepath"]
+                )
+
+                if not return_code:
+                    self.logger.info("attack_range has been built using terraform successfully")
+            else:
+                # the output of terraform is printed to the terminal, it isn't captured
+                self.logger.error("terraform plan failed, see the terraform output above for details.")
+                sys.exit(1)
+        finally:
+            if plan_file.exists():
+                plan_file.unlink()
 
+        self.invalidate_instances()
         self.show()
 
 
+    def copy_image_from_other_region(self, image, result) -> bool:
+        if not result:
+            return False
+
+        self.logger.info("Found image " + image + " in region " + result['region'] + ". Copy it to region " + self.config['aws']['region'])
+        if aws_service.copy_image(image, result['image_id'], result['region'], self.config['aws']['region']):
+            return True
+
+        # the hit may come from the cache, so the other regions weren't searched in this run
+        self.logger.info("Image " + image + " doesn't exist anymore in region " + result['region'] + ". Checking other regions again.")
+        result = aws_service.ami_available_other_region_batch([image])[image]
+        if not result:
+            return False
+
+        self.logger.info("Found image " + image + " in region " + result['region'] + ". Copy it to region " + self.config['aws']['region'])
+        return aws_service.copy_image(image, result['image_id'], result['region'], self.config['aws']['region'])
+
+    def build_images(self, images) -> None:
+        # create all commands first, so unsupported images exit in the main thread
+        commands = [self.packer_command(image) for image in images]
+        processes = [self.start_packer(image, command) for image, command in zip(images, commands)]
+
+        executor = ThreadPoolExecutor(max_workers=len(processes))
+        try:
+            list(executor.map(self.stream_output, processes, images))
+        except KeyboardInterrupt:
+            # only the main thread receives KeyboardInterrupt, forward it to every packer run
+            for process in processes:
+                if process.poll() is None:
+                    process.send_signal(signal.SIGINT)
+            for process in processes:
+                process.wait()
+            self.logger.error("Building images with packer was interrupted.")
+            sys.exit(1)
+        finally:
+            executor.shutdown(wait=True)
+
+        for process in processes:
+            process.wait()
+
+
     def destroy(self) -> None:
         self.logger.info("[action] > destroy\n")
 
         cwd = os.getcwd()
-        os.system('cd ' + os.path.join(os.path.dirname(__file__), '../terraform/aws') + '&& terraform init ')
+        os.system('cd ' + str(TERRAFORM_PATH) + '&& terraform init ')
         os.system('cd ' + cwd)
 
         return_code, stdout, stderr = self.terraform.destroy(
@@ -112,11 +223,22 @@ class AwsController(AttackRangeController):
             force=IsNotFlagged, 
             auto_approve=True
         )
+        self.invalidate_instances()
             
         self.logger.info("attack_range has been destroy using terraform successfully")
 
 
     def packer(self, image_name) -> None:
+        process = self.start_packer(image_name, self.packer_command(image_name))
+        try:
+            self.stream_output(process, image_name)
+        except KeyboardInterrupt:
+            process.send_signal(signal.SIGINT)
+            # keep reading, packer prints its cleanup and could block on a full pipe
+            self.stream_output(process, image_name)
+        process.wait()
+
+    def packer_command(self, image_name) -> list:
         self.logger.info("Create golden image for " + image_name + ". This can take up to 30 minutes.\n")
         only_cmd_arg = ""
         path_packer_file = ""
@@ -204,79 +326,122 @@ class AwsController(AttackRangeController):
             self.logger.error("Image not supported.")
             sys.exit(1)
 
+        return command
+
+    def start_packer(self, image_name, command):
         # disable packer color clears up output 
         envvars = dict(os.environ)
         envvars["PACKER_NO_COLOR"] = "1"
 
+        return subprocess.Popen(command, env=envvars, shell=False, stdout=subprocess.PIPE)
+
+    def stream_output(self, process, prefix) -> None:
+        # wait for output with a selector instead of blocking in readline, so the
+        # exit of the process is noticed even if it stops printing
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        selector = selectors.DefaultSelector()
+        selector.register(process.stdout, selectors.EVENT_READ)
+        pending = ''
         try:
-            process = subprocess.Popen(command, env=envvars, shell=False, universal_newlines=True, stdout=subprocess.PIPE)
-        except KeyboardInterrupt:
-            process.send_signal(signal.SIGINT)
-        while True:
-            output = process.stdout.readline()
-            if process.poll() is not None:
-                break
-            if output:
-                print(output.strip())
-        rc = process.poll()
+            while True:
+                if selector.select(timeout=0.1):
+                    chunk = os.read(process.stdout.fileno(), 65536)
+                    if not chunk:
+                        break
+                    pending += decoder.decode(chunk)
+                    lines = pending.split('\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        print("[" + prefix + "] " + line.strip())
+                elif process.poll() is not None:
+                    break
+        finally:
+            selector.close()
+
+        pending += decoder.decode(b'', final=True)
+        if pending.strip():
+            print("[" + prefix + "] " + pending.strip())
 
     def stop(self) -> None:
-        instances = aws_service.get_all_instances(self.config['general']['key_name'], self.config['general']['attack_range_name'], self.config['aws']['region'])
+        instances = self.get_instances()
         aws_service.change_ec2_state(instances, 'stopped', self.logger, self.config['aws']['region'])
+        self.invalidate_instances()
 
     def resume(self) -> None:
-        instances = aws_service.get_all_instances(self.config['general']['key_name'], self.config['general']['attack_range_name'], self.config['aws']['region'])
+        instances = self.get_instances()
         aws_service.change_ec2_state(instances, 'running', self.logger, self.config['aws']['region'])
+        self.invalidate_instances()
+
+    def get_instances(self) -> list:
+        # reuse the result of DescribeInstances for a short time, a single cli action often needs it several times
+        if self.instances is None or time.monotonic() - self.instances_timestamp > INSTANCES_CACHE_TTL:
+            self.instances = aws_service.get_all_instances(self.config['general']['key_name'], self.config['general']['attack_range_name'], self.config['aws']['region'])
+            self.instances_timestamp = time.monotonic()
+        return self.instances
+
+    def get_instance_public_ip(self, instance_name) -> str:
+        for instance in self.get_instances():
+            if instance['Tags'][0]['Value'] == instance_name:
+                return instance['NetworkInterfaces'][0]['Association']['PublicIp']
+
+        self.logger.error("Can't find instance " + instance_name)
+        sys.exit(1)
+
+    def invalidate_instances(self) -> None:
+        self.instances = None
+
+    def get_splunk_instance_name(self) -> str:
+        return "ar-splunk-" + self.config['general']['key_name'] + '-' + self.config['general']['attack_range_name']
 
     def simulate(self, engine, target, technique, playbook) -> None:
         self.logger.info("[action] > simulate\n")
-        if engine == "ART":
-            simulation_controller = ArtSimulationController(self.config)
-            simulation_controller.simulate(target, technique)
+        if engine not in SIMULATION_CONTROLLERS:
+            self.logger.error("Simulation engine " + engine + " not supported.")
+            sys.exit(1)
+
+        if engine not in self.simulation_controllers:
+            self.simulation_controllers[engine] = SIMULATION_CONTROLLERS[engine](self.config)
+        simulation_controller = self.simulation_controllers[engine]
+
         if engine == "PurpleSharp":
-            simulation_controller = PurplesharpSimulationController(self.config)
             simulation_controller.simulate(target, technique, playbook)
+        else:
+            simulation_controller.simulate(target, technique)
         
 
     def show(self) -> None:
         self.logger.info("[action] > show\n")
-        instances = aws_service.get_all_instances(self.config['general']['key_name'], self.config['general']['attack_range_name'], self.config['aws']['region'])
+        instances = self.get_instances()
+        private_key_path = self.config['aws']['private_key_path']
+        password = self.config['general']['attack_range_password']
+        splunk_scheme = "https" if self.config["splunk_server"]["install_es"] == "1" else "http"
         response = []
         messages = []
         instances_running = False
         splunk_ip = ""
         for instance in instances:
-            if instance['State']['Name'] == 'running':
+            instance_name = instance['Tags'][0]['Value']
+            instance_state = instance['State']['Name']
+            if instance_state == 'running':
                 instances_running = True
-                response.append([instance['Tags'][0]['Value'], instance['State']['Name'],
-                                    instance['NetworkInterfaces'][0]['Association']['PublicIp']])
-                instance_name = instance['Tags'][0]['Value']
-                if instance_name.startswith("ar-splunk"):
-                    splunk_ip = instance['NetworkInterfaces'][0]['Association']['PublicIp']
-                    messages.append("\nAccess Guacamole via:\n\tWeb > http://" + instance['NetworkInterfaces'][0]['Association']['PublicIp'] + ":8080/guacamole" + "\n\tusername: Admin \n\tpassword: " + self.config['general']['attack_range_password'])
-                    if self.config["splunk_server"]["install_es"] == "1":
-                        messages.append("\nAccess Splunk via:\n\tWeb > https://" + instance['NetworkInterfaces'][0]['Association']['PublicIp'] + ":8000\n\tSSH > ssh -i" + self.config['aws']['private_key_path'] + " ubuntu@" + instance['NetworkInterfaces'][0]['Association']['PublicIp'] + "\n\tusername: admin \n\tpassword: " + self.config['general']['attack_range_password'])
-                    else:
-                        messages.append("\nAccess Splunk via:\n\tWeb > http://" + instance['NetworkInterfaces'][0]['Association']['PublicIp'] + ":8000\n\tSSH > ssh -i" + self.config['aws']['private_key_path'] + " ubuntu@" + instance['NetworkInterfaces'][0]['Association']['PublicIp'] + "\n\tusername: admin \n\tpassword: " + self.config['general']['attack_range_password'])
-                elif instance_name.startswith("ar-phantom"):
-                    messages.append("\nAccess Phantom via:\n\tWeb > https://" + instance['NetworkInterfaces'][0]['Association']['PublicIp'] + ":8443" + "\n\tSSH > ssh -i" + self.config['aws']['private_key_path'] + " centos@" + instance['NetworkInterfaces'][0]['Association']['PublicIp'] + "\n\tusername: admin \n\tpassword: " + self.config['general']['attack_range_password'])
-                elif instance_name.startswith("ar-win"):
-                    messages.append("\nAccess Windows via:\n\tRDP > rdp://" + instance['NetworkInterfaces'][0]['Association']['PublicIp'] + ":3389\n\tusername: Administrator \n\tpassword: " + self.config['general']['attack_range_password'])
-                elif instance_name.startswith("ar-linux"):
-                    messages.append("\nAccess Linux via:\n\tSSH > ssh -i" + self.config['aws']['private_key_path'] + " ubuntu@" + instance['NetworkInterfaces'][0]['Association']['PublicIp'] + "\n\tusername: ubuntu \n\tpassword: " + self.config['general']['attack_range_password'])
-                elif instance_name.startswith("ar-kali"):
-                    messages.append("\nAccess Kali via:\n\tSSH > ssh -i" + self.config['aws']['private_key_path'] + " kali@" + instance['NetworkInterfaces'][0]['Association']['PublicIp'] + "\n\tusername: kali \n\tpassword: " + self.config['general']['attack_range_password'])
-                elif instance_name.startswith("ar-nginx"):
-                    messages.append("\nAccess Nginx Web Proxy via:\n\tSSH > ssh -i" + self.config['aws']['private_key_path'] + " ubuntu@" + instance['NetworkInterfaces'][0]['Association']['PublicIp'] + "\n\tusername: kali \n\tpassword: " + self.config['general']['attack_range_password'])
-                elif instance_name.startswith("ar-zeek"):
-                    messages.append("\nAccess Zeek via:\n\tSSH > ssh -i" + self.config['aws']['private_key_path'] + " ubuntu@" + instance['NetworkInterfaces'][0]['Association']['PublicIp'] + "\n\tusername: ubuntu \n\tpassword: " + self.config['general']['attack_range_password'])                
+                public_ip = instance['NetworkInterfaces'][0]['Association']['PublicIp']
+                response.append([instance_name, instance_state, public_ip])
+                prefix = next((p for p in MESSAGE_TEMPLATES if instance_name.startswith(p)), None)
+                if prefix:
+                    messages.append(MESSAGE_TEMPLATES[prefix].format(
+                        ip=public_ip,
+                        key=private_key_path,
+                        password=password,
+                        splunk_scheme=splunk_scheme
+                    ))
+                if prefix == "ar-splunk":
+                    splunk_ip = public_ip
             else:
-                response.append([instance['Tags'][0]['Value'],
-                                    instance['State']['Name']])
+                response.append([instance_name, instance_state])
 
         if self.config['simulation']['prelude'] == "1":
             prelude_token = self.get_prelude_token('/var/tmp/.prelude_session_token')
-            messages.append("\nAccess Prelude Operator UI via:\n\tredirector FQDN > " + splunk_ip + "\n\tToken: " + prelude_token + "\n\tSee guide details: https://github.com/splunk/attack_range/wiki/Prelude-Operator")
+            messages.append(f"\nAccess Prelude Operator UI via:\n\tredirector FQDN > {splunk_ip}\n\tToken: {prelude_token}\n\tSee guide details: https://github.com/splunk/attack_range/wiki/Prelude-Operator")
 
         print()
         print('Status Virtual Machines\n')
@@ -298,14 +463,22 @@ class AwsController(AttackRangeController):
         self.logger.info("Dump log data")
         dump_search = "search " + search + " earliest=-" + earliest + " latest=" + latest + " | sort 0 _time"
         self.logger.info("Dumping Splunk Search: " + dump_search)
-        out = open(os.path.join(os.path.dirname(__file__), "../" + dump_name), 'wb')
-
-        splunk_instance = "ar-splunk-" + self.config['general']['key_name'] + '-' + self.config['general']['attack_range_name']
-        splunk_sdk.export_search(aws_service.get_single_instance_public_ip(splunk_instance, self.config['general']['key_name'], self.config['general']['attack_range_name'], self.config['aws']['region']),
-                                    s=dump_search,
-                                    password=self.config['general']['attack_range_password'],
-                                    out=out)
-        out.close()
+        dump_path = (ROOT_PATH / dump_name).resolve()
+        if ROOT_PATH not in dump_path.parents:
+            self.logger.error("Dump file " + dump_name + " has to be inside of the attack_range folder.")
+            sys.exit(1)
+
+        if dump_name.endswith(".gz"):
+            out = gzip.open(dump_path, 'wb', compresslevel=1)
+        else:
+            out = io.BufferedWriter(io.FileIO(dump_path, 'w'), buffer_size=1 << 20)
+
+        splunk_instance = self.get_splunk_instance_name()
+        with out:
+            splunk_sdk.export_search(self.get_instance_public_ip(splunk_instance),
+                                        s=dump_search,
+                                        password=self.config['general']['attack_range_password'],
+                                        out=out)
         self.logger.info("[Completed]")
 
     def replay(self, file_name, index, sourcetype, source) -> None:
@@ -319,24 +492,45 @@ class AwsController(AttackRangeController):
         ansible_vars['source'] = source
         ansible_vars['index'] = index
 
-        splunk_instance = "ar-splunk-" + self.config['general']['key_name'] + '-' + self.config['general']['attack_range_name']
-        splunk_ip = aws_service.get_single_instance_public_ip(splunk_instance, self.config['general']['key_name'], self.config['general']['attack_range_name'], self.config['aws']['region'])
+        splunk_instance = self.get_splunk_instance_name()
+        splunk_ip = self.get_instance_public_ip(splunk_instance)
         cmdline = "-i %s, -u %s" % (splunk_ip, ansible_vars['ansible_user'])
-        runner = ansible_runner.run(private_data_dir=os.path.join(os.path.dirname(__file__), '../'),
+        runner = ansible_runner.run(private_data_dir=str(ROOT_PATH),
                                     cmdline=cmdline,
-                                    roles_path=os.path.join(os.path.dirname(__file__), 'ansible/roles'),
-                                    playbook=os.path.join(os.path.dirname(__file__), 'ansible/data_replay.yml'),
-                                    extravars=ansible_vars)
+                                    roles_path=str(ANSIBLE_ROLES_PATH),
+                                    playbook=str(DATA_REPLAY_PLAYBOOK),
+                                    extravars=ansible_vars,
+                                    envvars=self.ansible_envvars())
+
+
+    def ansible_envvars(self) -> dict:
+        # with pipelining all tasks run over the ssh connection kept open by ansible's default ControlPersist
+        envvars = {}
+        if 'ANSIBLE_PIPELINING' not in os.environ:
+            envvars['ANSIBLE_PIPELINING'] = 'True'
+
+        if self.config['aws'].get('ansible_mitogen', "0") == "1":
+            try:
+                import ansible_mitogen
+            except ImportError:
+                self.logger.error("ansible_mitogen is enabled, but mitogen is not installed.")
+                sys.exit(1)
+
+            envvars['ANSIBLE_STRATEGY_PLUGINS'] = os.path.join(os.path.dirname(ansible_mitogen.__file__), 'plugins', 'strategy')
+            envvars['ANSIBLE_STRATEGY'] = 'mitogen_linear'
+
+        return envvars
 
 
     def get_prelude_token(self, token_path):
-        token = ''
-        try:
-            prelude_token_file = open(token_path,'r')
-            token = prelude_token_file.read()
-        except Exception as e:
-            self.logger.error("was not able to read prelude token from {}".format(token_path))
-        return token
+        token_file = Path(token_path)
+        if token_file.is_file():
+            try:
+                return token_file.read_text().strip()
+            except OSError:
+                pass
+        self.logger.error("was not able to read prelude token from {}".format(token_path))
+        return ''
 
 
     def create_remote_backend(self, backend_name) -> None:
@@ -356,16 +550,16 @@ class AwsController(AttackRangeController):
             key_material = aws_service.create_key_pair(backend_name, self.config['aws']['region'], self.logger)
             aws_service.create_secret(backend_name, key_material, self.config, self.logger)
 
-        with open(os.path.join(os.path.dirname(__file__), '../attack_range.yml'), 'w') as outfile:
+        with open(ROOT_PATH / 'attack_range.yml', 'w') as outfile:
             yaml.dump(self.config, outfile, default_flow_style=False, sort_keys=False)
 
         # write versions.tf
         j2_env = Environment(
-            loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), '../terraform/aws')), 
+            loader=FileSystemLoader(str(TERRAFORM_PATH)), 
             trim_blocks=True)
         template = j2_env.get_template('versions.tf.j2')
         output = template.render(backend_name=backend_name, region=self.config['aws']['region'])
-        with open('terraform/aws/versions.tf', 'w') as f:
+        with open(TERRAFORM_PATH / 'versions.tf', 'w') as f:
             output = output.encode('ascii', 'ignore').decode('ascii')
             f.write(output)
 
@@ -376,11 +570,11 @@ class AwsController(AttackRangeController):
         aws_service.delete_secret(backend_name, self.logger)
         aws_service.delete_key_pair(backend_name, self.config['aws']['region'], self.logger)
         try:
-            os.remove(os.path.join(os.path.dirname(__file__), '../terraform/aws/versions.tf'))
+            os.remove(TERRAFORM_PATH / 'versions.tf')
         except Exception as e:
             self.logger.error(e)
         try:
-            os.remove(os.path.join(os.path.dirname(__file__), '../', backend_name + '.key'))
+            os.remove(ROOT_PATH / (backend_name + '.key'))
         except Exception as e:
             self.logger.error(e)
 
@@ -396,15 +590,15 @@ class AwsController(AttackRangeController):
         aws_service.get_secret_key(backend_name, self.logger)
         config = aws_service.get_secret_config(backend_name, self.logger)
         config['aws']['private_key_path'] = str(Path(backend_name + '.key').resolve())
-        with open(os.path.join(os.path.dirname(__file__), '../attack_range.yml'), 'w') as outfile:
+        with open(ROOT_PATH / 'attack_range.yml', 'w') as outfile:
             yaml.dump(config, outfile, default_flow_style=False, sort_keys=False)
 
         # write versions.tf
         j2_env = Environment(
-            loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), '../terraform/aws')), 
+            loader=FileSystemLoader(str(TERRAFORM_PATH)), 
             trim_blocks=True)
         template = j2_env.get_template('versions.tf.j2')
         output = template.render(backend_name=backend_name, region=self.config['aws']['region'])
-        with open('terraform/aws/versions.tf', 'w') as f:
+        with open(TERRAFORM_PATH / 'versions.tf', 'w') as f:
             output = output.encode('ascii', 'ignore').decode('ascii')
             f.write(output)
@@ -1,9 +1,63 @@
 
 import boto3
+import botocore.config
+import botocore.exceptions
+import functools
 import sys
 import os
 import json
 import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+# adaptive retries rate limit the client side when AWS throttles the parallel calls
+BOTO_CONFIG = botocore.config.Config(retries={'max_attempts': 10, 'mode': 'adaptive'})
+
+AMI_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.attack_range', 'ami_cache.json')
+AMI_CACHE_TTL = 24 * 60 * 60
+AMI_CACHE_NEGATIVE_TTL = 60 * 60
+AMI_OTHER_REGION_CACHE_TTL = 7 * 24 * 60 * 60
+
+# (account_id, region, ami_name) -> {'image': <image metadata or None>, 'ts': <epoch>, 'ttl': <seconds>}
+_AMI_CACHE = {}
+_AMI_CACHE_LOADED = False
+_AMI_CACHE_LOCK = threading.Lock()
+
+AMI_REGIONS = [
+    "us-east-1",
+    "us-east-2",
+    "us-west-1",
+    "us-west-2",
+    "ca-central-1",
+    "eu-west-1",
+    "eu-west-2",
+    "eu-central-1",
+    "ap-southeast-1",
+    "ap-southeast-2",
+    "ap-south-1",
+    "ap-northeast-1",
+    "ap-northeast-2",
+    "sa-east-1",
+    "cn-north-1"
+]
+
+
+@functools.lru_cache(maxsize=None)
+def ec2_client(region):
+    """
+    Returns a shared EC2 client per region, so all calls reuse the same session and connection pool.
+    The connection pool is sized for the parallel DescribeImages calls of the AMI lookups.
+    """
+    config = BOTO_CONFIG.merge(botocore.config.Config(max_pool_connections=32))
+    return boto3.Session().client('ec2', region_name=region, config=config)
+
+
+@functools.lru_cache(maxsize=None)
+def get_account_id():
+    client = boto3.client('sts', config=BOTO_CONFIG)
+    return client.get_caller_identity()['Account']
 
 
 def check_region(config_region):
@@ -13,7 +67,7 @@ def check_region(config_region):
 
 
 def get_all_instances(key_name, ar_name, region):
-    client = boto3.client('ec2', region_name=region)
+    client = ec2_client(region)
     response = client.describe_instances(
         Filters=[
             {
@@ -49,7 +103,7 @@ def get_single_instance_public_ip(ec2_name, key_name, ar_name, region):
 
 
 def change_ec2_state(instances, new_state, log, region):
-    client = boto3.client('ec2', region_name=region)
+    client = ec2_client(region)
 
     if len(instances) == 0:
         log.error('No instance passed.')
@@ -73,81 +127,247 @@ def change_ec2_state(instances, new_state, log, region):
                 log.info('Successfully started instance with ID ' + instance['InstanceId'] + ' .')
 
 
-def ami_available(ami_name, region):
-    client = boto3.client('ec2', region_name=region)
-    try:
-        images = client.describe_images(Owners=['self'])
-    except:
-        return False
+def load_ami_cache():
+    global _AMI_CACHE_LOADED
+    with _AMI_CACHE_LOCK:
+        if _AMI_CACHE_LOADED:
+            return
+        _AMI_CACHE_LOADED = True
+
+        try:
+            with open(AMI_CACHE_PATH, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        for entry in entries:
+            if 'account' in entry and 'ttl' in entry:
+                _AMI_CACHE[(entry['account'], entry['region'], entry['name'])] = {'image': entry['image'], 'ts': entry['ts'], 'ttl': entry['ttl']}
+
+
+def save_ami_cache():
+    with _AMI_CACHE_LOCK:
+        entries = []
+        for (account, region, name), value in _AMI_CACHE.items():
+            entries.append({'account': account, 'region': region, 'name': name, 'image': value['image'], 'ts': value['ts'], 'ttl': value['ttl']})
+
+        try:
+            os.makedirs(os.path.dirname(AMI_CACHE_PATH), exist_ok=True)
+            with open(AMI_CACHE_PATH, 'w') as f:
+                json.dump(entries, f)
+        except OSError:
+            pass
+
+
+def get_cached_ami(ami_name, region):
+    """
+    Returns the AMI cache entry for an AMI name of the current account or None if there is no fresh entry.
+    A fresh entry with image None is a cached negative lookup.
+    """
+    load_ami_cache()
+    entry = _AMI_CACHE.get((get_account_id(), region, ami_name))
+    if entry is None:
+        return None
+
+    if time.time() - entry['ts'] > entry['ttl']:
+        return None
+
+    return entry
+
+
+def cache_ami(ami_name, region, image, ttl=None):
+    if ttl is None:
+        ttl = AMI_CACHE_TTL if image else AMI_CACHE_NEGATIVE_TTL
+    with _AMI_CACHE_LOCK:
+        _AMI_CACHE[(get_account_id(), region, ami_name)] = {'image': image, 'ts': time.time(), 'ttl': ttl}
+
+
+def forget_ami(ami_name, region):
+    with _AMI_CACHE_LOCK:
+        _AMI_CACHE.pop((get_account_id(), region, ami_name), None)
+
+
+def describe_ami_images(ami_names, region, key='name'):
+    """
+    Looks up all given AMI names owned by this account in a region with a single DescribeImages call.
+    @param ami_names: list of AMI names, or AMI ids if key is 'image-id'
+    @param region: AWS region
+    @param key: DescribeImages filter to match ami_names against
+    @return: dict of AMI name to image metadata for all available AMIs found
+    """
+    client = ec2_client(region)
+    response = client.describe_images(
+        Owners=['self'],
+        Filters=[
+            {
+                'Name': key,
+                'Values': list(ami_names)
+            },
+            {
+                'Name': 'state',
+                'Values': ['available']
+            }
+        ]
+    )
 
-    for image in images["Images"]:
+    images = {}
+    for image in response['Images']:
         if 'Name' in image:
-            if ami_name == image["Name"]:
-                if image["State"] == "available":
-                    return True
+            images[image['Name']] = {
+                'ImageId': image['ImageId'],
+                'Name': image['Name'],
+                'State': image['State']
+            }
 
-    return False
+    return images
+
+
+def get_ami_images(ami_names, region, cache_negative=False, verify_cached=False):
+    """
+    Returns the image metadata of all available AMIs in a region, served from the AMI cache where possible.
+    Only AMIs without a fresh cache entry are looked up in AWS, with a single DescribeImages call.
+    @param ami_names: list of AMI names
+    @param region: AWS region
+    @param cache_negative: also cache AMIs which were not found
+    @param verify_cached: check with a single DescribeImages call by id that cached AMIs still exist
+    """
+    images = {}
+    missing = []
+    for ami_name in ami_names:
+        entry = get_cached_ami(ami_name, region)
+        if entry is None or (entry['image'] is None and not cache_negative):
+            missing.append(ami_name)
+        elif entry['image']:
+            images[ami_name] = entry['image']
+
+    if verify_cached and images:
+        try:
+            existing = describe_ami_images([image['ImageId'] for image in images.values()], region, key='image-id')
+        except Exception:
+            existing = {}
+
+        for ami_name, image in list(images.items()):
+            if ami_name not in existing or existing[ami_name]['ImageId'] != image['ImageId']:
+                forget_ami(ami_name, region)
+                del images[ami_name]
+                missing.append(ami_name)
+
+    if missing:
+        try:
+            found = describe_ami_images(missing, region)
+        except Exception:
+            return images
+
+        for ami_name in missing:
+            image = found.get(ami_name)
+            if image or cache_negative:
+                cache_ami(ami_name, region, image)
+            if image:
+                images[ami_name] = image
+
+    return images
+
+
+def ami_available_batch(ami_names, region):
+    images = get_ami_images(ami_names, region, verify_cached=True)
+    save_ami_cache()
+    return {ami_name: ami_name in images for ami_name in ami_names}
+
+
+def get_ami_regions():
+    """
+    Returns the regions enabled for this account, in the order of AMI_REGIONS for the known ones.
+    Falls back to AMI_REGIONS if the regions can't be described.
+    """
+    try:
+        response = ec2_client(boto3.session.Session().region_name).describe_regions()
+    except Exception:
+        return AMI_REGIONS
+
+    enabled = [region['RegionName'] for region in response['Regions']]
+    return [region for region in AMI_REGIONS if region in enabled] + [region for region in enabled if region not in AMI_REGIONS]
+
+
+def get_cached_ami_other_region(ami_name):
+    """
+    Returns the region and id of a fresh cached hit for an AMI name in any region, or {} if there is none.
+    """
+    load_ami_cache()
+    account_id = get_account_id()
+    for entry_account_id, region, name in list(_AMI_CACHE):
+        if entry_account_id == account_id and name == ami_name:
+            entry = get_cached_ami(ami_name, region)
+            if entry and entry['image']:
+                return {"region": region, "image_id": entry['image']['ImageId']}
 
+    return {}
 
-def ami_available_other_region(ami_name):
-    regions = [
-        "us-east-1", 
-        "us-east-2", 
-        "us-west-1", 
-        "us-west-2", 
-        "ca-central-1", 
-        "eu-west-1", 
-        "eu-west-2", 
-        "eu-central-1", 
-        "ap-southeast-1", 
-        "ap-southeast-2", 
-        "ap-south-1", 
-        "ap-northeast-1", 
-        "ap-northeast-2", 
-        "sa-east-1", 
-        "cn-north-1"
-    ]
-
-    for region in regions:
-        if ami_available(ami_name, region):
-            return {"region": region, "image_id": get_image_id(ami_name, region)}
 
-    return {}
+def ami_available_other_region_batch(ami_names):
+    """
+    Searches all regions for the given AMI names, with one DescribeImages call per region.
+    Hits are kept in the AMI cache for AMI_OTHER_REGION_CACHE_TTL, so only AMIs without a
+    fresh hit in any region are searched. The regions are scanned in parallel, the first
+    region in the order of get_ami_regions() containing an AMI wins.
+    @return: dict of AMI name to {'region': ..., 'image_id': ...} or {} if the AMI wasn't found
+    """
+    results = {}
+    missing = []
+    for ami_name in ami_names:
+        results[ami_name] = get_cached_ami_other_region(ami_name)
+        if not results[ami_name]:
+            missing.append(ami_name)
 
+    if not missing:
+        return results
 
+    regions = get_ami_regions()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        found = list(executor.map(lambda region: get_ami_images(missing, region, cache_negative=True), regions))
 
-def get_image_id(ami_name, region):
-    client = boto3.client('ec2', region_name=region)
-    images = client.describe_images(Owners=['self'])
+    for region, images in zip(regions, found):
+        for ami_name, image in images.items():
+            if not results[ami_name]:
+                results[ami_name] = {"region": region, "image_id": image['ImageId']}
+                cache_ami(ami_name, region, image, ttl=AMI_OTHER_REGION_CACHE_TTL)
+    save_ami_cache()
 
-    for ami in images["Images"]:
-        if ami_name == ami["Name"]:
-            return ami["ImageId"]
+    return results
 
 
 def copy_image(ami_name, ami_image_id, source_region, dest_region):
-    session = boto3.client('ec2',region_name=dest_region)
+    session = ec2_client(dest_region)
 
-    response = session.copy_image(
-        Name=ami_name,
-        Description='Copied this AMI from region ' + source_region,
-        SourceImageId=ami_image_id,
-        SourceRegion=source_region
-    )
+    try:
+        response = session.copy_image(
+            Name=ami_name,
+            Description='Copied this AMI from region ' + source_region,
+            SourceImageId=ami_image_id,
+            SourceRegion=source_region
+        )
+    except botocore.exceptions.ClientError as e:
+        # the source AMI came from a stale cache entry
+        if not e.response['Error']['Code'].startswith('InvalidAMIID'):
+            raise
+        forget_ami(ami_name, source_region)
+        save_ami_cache()
+        return False
 
     for x in range(0, 10):
-        if ami_available(ami_name, dest_region):
+        if ami_available_batch([ami_name], dest_region)[ami_name]:
             break
         print("Image not yet available. " + str(10-x) + " tries left.")
         time.sleep(60)
 
-    if not ami_available(ami_name, dest_region):
+    if not ami_available_batch([ami_name], dest_region)[ami_name]:
         print("Error: Copying of AMI took longer as expected.")
         sys.exit(1)
 
+    return True
+
 
 def check_s3_bucket(bucket_name):
-    client = boto3.client('s3')
+    client = boto3.client('s3', config=BOTO_CONFIG)
     some_binary_data = b'Here we have some data'
 
     try:
@@ -160,7 +380,7 @@ def check_s3_bucket(bucket_name):
 
 
 def create_s3_bucket(bucket_name, region, logger):
-    client = boto3.client("s3", region_name=region)
+    client = boto3.client("s3", region_name=region, config=BOTO_CONFIG)
     location = {'LocationConstraint': region}
     
     try:
@@ -174,7 +394,7 @@ def create_s3_bucket(bucket_name, region, logger):
 
 
 def create_dynamoo_db(name, region, logger):
-    client = boto3.client('dynamodb', region_name=region)
+    client = boto3.client('dynamodb', region_name=region, config=BOTO_CONFIG)
     try:
         response = client.create_table(
             TableName=name,
@@ -207,7 +427,7 @@ def create_dynamoo_db(name, region, logger):
 
 
 def delete_s3_bucket(bucket_name, region, logger):
-    s3 = boto3.resource('s3', region_name=region)
+    s3 = boto3.resource('s3', region_name=region, config=BOTO_CONFIG)
     try:
         bucket = s3.Bucket(bucket_name)
         bucket.objects.all().delete()
@@ -220,7 +440,7 @@ def delete_s3_bucket(bucket_name, region, logger):
 
 
 def delete_dynamo_db(name, region, logger):
-    dynamodb = boto3.resource('dynamodb', region_name=region)
+    dynamodb = boto3.resource('dynamodb', region_name=region, config=BOTO_CONFIG)
     try:
         table = dynamodb.Table(name)
         table.delete()
@@ -232,7 +452,7 @@ def delete_dynamo_db(name, region, logger):
 
 
 def check_secret_exists(name):
-    client = boto3.client('secretsmanager')
+    client = boto3.client('secretsmanager', config=BOTO_CONFIG)
     response = client.list_secrets()
     for secret in response['SecretList']:
         if secret['Name'] == str(name + '-key'):
@@ -242,7 +462,7 @@ def check_secret_exists(name):
 
 
 def create_secret(name, value, config, logger):
-    client = boto3.client('secretsmanager')
+    client = boto3.client('secretsmanager', config=BOTO_CONFIG)
     key_name = name + '-key'
     config_name = name + '-config'
     try:
@@ -263,7 +483,7 @@ def create_secret(name, value, config, logger):
 
 
 def get_secret_key(name, logger):
-    client = boto3.client('secretsmanager')
+    client = boto3.client('secretsmanager', config=BOTO_CONFIG)
 
     response = client.get_secret_value(
         SecretId=name + '-key'
@@ -275,7 +495,7 @@ def get_secret_key(name, logger):
 
 
 def get_secret_config(name, logger):
-    client = boto3.client('secretsmanager')
+    client = boto3.client('secretsmanager', config=BOTO_CONFIG)
     
     response = client.get_secret_value(
         SecretId=name + '-config'
@@ -285,7 +505,7 @@ def get_secret_config(name, logger):
 
 
 def delete_secret(name, logger):
-    client = boto3.client('secretsmanager')
+    client = boto3.client('secretsmanager', config=BOTO_CONFIG)
 
     try:
         response = client.delete_secret(
@@ -304,8 +524,7 @@ def delete_secret(name, logger):
 
 
 def create_key_pair(name, region, logger):
-    aws_session = boto3.Session()
-    client = aws_session.client('ec2', region_name=region)
+    client = ec2_client(region)
 
     response = client.create_key_pair(KeyName=name)
     ssh_key_name = name + ".key"
@@ -319,5 +538,5 @@ def create_key_pair(name, region, logger):
 
 
 def delete_key_pair(name, region, logger):
-    ec2 = boto3.client('ec2', region_name=region)
+    ec2 = ec2_client(region)
     response = ec2.delete_key_pair(KeyName=name)
@@ -22,10 +22,13 @@ def export_search(host, s, password, export_mode="raw", out=sys.stdout, username
     """
     import urllib3
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-    r = requests.post("https://%s:%d/servicesNS/admin/search/search/jobs/export" % (host, splunk_rest_port),
-                      auth=(username, password),
-                      data={'output_mode': export_mode,
-                            'search': s,
-                            'max_count': 1000000},
-                      verify=False)
-    out.write(r.text.encode('utf-8'))
\ No newline at end of file
+    with requests.post("https://%s:%d/servicesNS/admin/search/search/jobs/export" % (host, splunk_rest_port),
+                       auth=(username, password),
+                       data={'output_mode': export_mode,
+                             'search': s,
+                             'max_count': 1000000},
+                       verify=False,
+                       stream=True) as r:
+        r.raise_for_status()
+        for chunk in r.iter_content(chunk_size=65536):
+            out.write(chunk)
\ No newline at end of file